@@ -13,8 +13,14 @@ print("Installing numpy 1.22.4...")
 subprocess.check_call([sys.executable, "-m", "pip", "install", "numpy==1.22.4", "--only-binary=:all:"])
 
 # 2. Install TensorFlow via pip
-print("Installing TensorFlow...")
-subprocess.check_call([sys.executable, "-m", "pip", "install", "tensorflow==2.13.0"])
+if is_mac_arm:
+    # Apple Silicon: add the Metal plugin so TensorFlow can run on the GPU.
+    # tensorflow-metal 1.0.0 is the release built for TensorFlow 2.13
+    print("Installing TensorFlow with the Metal GPU plugin for Apple Silicon...")
+    subprocess.check_call([sys.executable, "-m", "pip", "install", "tensorflow-macos==2.13.0", "tensorflow-metal==1.0.0"])
+else:
+    print("Installing TensorFlow...")
+    subprocess.check_call([sys.executable, "-m", "pip", "install", "tensorflow==2.13.0"])
 
 
 # 3. Install other critical dependencies
@@ -15,6 +15,9 @@ Arguments:
   --layout: Layout to use for finding neighbors (umap, tsne, etc.) [default: umap]
   --include_thumbs: Include thumbnail paths in output
   --include_metadata: Include all available metadata in output
+  --approximate: Use an approximate (Annoy) nearest neighbor index for high-dimensional layouts
+  --n_trees: Number of trees to build in the approximate index [default: 50]
+  --no_cache: Reload all PixPlot data instead of using data cached by a previous run
 
 Note: This script should point to the main output directory that contains the manifest.json file.
 """
@@ -22,13 +25,45 @@ Note: This script should point to the main output directory that contains the ma
 import os
 import json
 import gzip
-import csv
 import numpy as np
+import pandas as pd
 import argparse
-from scipy.spatial import distance
 from datetime import datetime
 import glob
+import fnmatch
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+try:
+    from annoy import AnnoyIndex
+except ImportError:
+    AnnoyIndex = None
+
+try:
+    from sklearn.metrics import pairwise_distances
+except ImportError:
+    pairwise_distances = None
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+# Filename prefix for the parsed data cached next to the manifest
+CACHE_PREFIX = '.pixplot_cache_'
+
+# Buffer size for CSV output, large enough to batch many rows per write() call
+CSV_BUFFER_SIZE = 1 << 20
 
 def timestamp():
     """Return a string for printing the current time"""
@@ -39,14 +74,40 @@ def read_json(path, gzipped=False, encoding='utf8'):
     try:
         if gzipped or path.endswith('.gz'):
             with gzip.GzipFile(path, 'r') as f:
-                return json.loads(f.read().decode(encoding))
+                data = f.read()
         else:
-            with open(path) as f:
-                return json.load(f)
+            with open(path, 'rb') as f:
+                data = f.read()
+        # orjson parses the raw UTF-8 bytes directly, without decoding to str first.
+        # It rejects NaN and Infinity, which the stdlib json module reads and writes,
+        # so retry with json to keep parsing the same files as before
+        if orjson is not None:
+            try:
+                return orjson.loads(data)
+            except orjson.JSONDecodeError:
+                pass
+        return json.loads(data.decode(encoding))
     except Exception as e:
         print(f"Error reading {path}: {e}")
         return None
 
+def list_dir(path):
+    """List the file names in a directory, returning an empty list if it doesn't exist"""
+    try:
+        return sorted(entry.name for entry in os.scandir(path))
+    except OSError:
+        return []
+
+def find_files(directory, pattern, names=None):
+    """Find the paths of files in a directory whose names match a glob pattern
+
+    Pass the directory's `names` from list_dir to match several patterns
+    against a single listing.
+    """
+    if names is None:
+        names = list_dir(directory)
+    return [os.path.join(directory, name) for name in fnmatch.filter(names, pattern)]
+
 def get_layout_path(data_dir, plot_id, layout_name):
     """Find the path to a layout file"""
     layout_dir = os.path.join(data_dir, 'layouts')
@@ -59,132 +120,293 @@ def get_layout_path(data_dir, plot_id, layout_name):
         else:
             return None
     
+    # List the layout directory once and match every candidate against it
+    names = list_dir(layout_dir)
+    
     # Try both compressed and uncompressed formats
     candidates = [
-        # Standard layout
-        os.path.join(layout_dir, f"{layout_name}-{plot_id}.json.gz"),
-        os.path.join(layout_dir, f"{layout_name}-{plot_id}.json"),
+        # Standard layout, matched by exact name
+        *[os.path.join(layout_dir, name) for name in
+          [f"{layout_name}-{plot_id}.json.gz", f"{layout_name}-{plot_id}.json"] if name in names],
         
         # For umap with different parameters
-        *glob.glob(os.path.join(layout_dir, f"umap-n_neighbors_*-min_dist_*-{plot_id}.json.gz")),
-        *glob.glob(os.path.join(layout_dir, f"umap-n_neighbors_*-min_dist_*-{plot_id}.json"))
+        *find_files(layout_dir, f"umap-n_neighbors_*-min_dist_*-{glob.escape(str(plot_id))}.json.gz", names),
+        *find_files(layout_dir, f"umap-n_neighbors_*-min_dist_*-{glob.escape(str(plot_id))}.json", names)
     ]
     
-    for candidate in candidates:
-        if os.path.exists(candidate):
-            return candidate
+    if candidates:
+        return candidates[0]
             
     print(f"Could not find layout file for {layout_name}")
     return None
 
-def load_metadata(data_dir, image_filenames):
-    """Load metadata for all images"""
+def get_metadata_dir(data_dir):
+    """Find the directory holding per-image metadata files, or None if there is none"""
     # Try different possible metadata locations
     metadata_dirs = [
         os.path.join(data_dir, 'metadata', 'file'),
         os.path.join(data_dir, 'data', 'metadata', 'file')
     ]
     
-    metadata_dir = None
     for dir_path in metadata_dirs:
         if os.path.exists(dir_path):
-            metadata_dir = dir_path
-            break
-            
+            return dir_path
+    return None
+
+def load_metadata(data_dir, base_filenames, cache_path=None, cache_key=None):
+    """Load metadata for all images, given their base filenames
+    
+    If `cache_path` is given, reuse metadata cached under that path when
+    `cache_key` and the metadata files are unchanged, and cache it otherwise.
+    """
+    metadata_dir = get_metadata_dir(data_dir)
     if not metadata_dir:
         print(f"Metadata directory not found in any expected location")
         return {}
     
-    metadata = {}
-    for filename in image_filenames:
-        base_filename = os.path.basename(filename)
-        metadata_path = os.path.join(metadata_dir, base_filename + '.json')
-        if os.path.exists(metadata_path):
-            try:
-                with open(metadata_path) as f:
-                    metadata[base_filename] = json.load(f)
-            except Exception as e:
-                print(f"Error reading metadata for {base_filename}: {e}")
-                metadata[base_filename] = {}
-        else:
-            metadata[base_filename] = {}
-            
+    # List the metadata directory once instead of checking for each file
+    entries = list(os.scandir(metadata_dir))
+    metadata_paths = {entry.name: entry.path for entry in entries}
+    
+    if cache_path:
+        # Editing a file in place doesn't change the directory's mtime, so also
+        # key on the number of files and the newest file mtime (a stat, not a parse)
+        mtimes = [entry.stat().st_mtime_ns for entry in entries]
+        cache_key = cache_key + get_cache_key(metadata_dir) + [[len(mtimes), max(mtimes, default=0)]]
+        cached = read_metadata_cache(cache_path, cache_key)
+        if cached is not None:
+            print(f"Loading cached metadata from {cache_path}-metadata.json")
+            return cached
+    
+    def read_metadata(base_filename):
+        metadata_path = metadata_paths.get(base_filename + '.json')
+        if not metadata_path:
+            return {}
+        return read_json(metadata_path) or {}
+    
+    # Reading many small files is I/O bound, so overlap the reads in threads
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        metadata = dict(zip(base_filenames, executor.map(read_metadata, base_filenames)))
+    
+    if cache_path:
+        write_metadata_cache(cache_path, cache_key, metadata)
     return metadata
 
-def find_nearest_neighbors(positions, n_neighbors):
-    """Find n nearest neighbors for each point based on Euclidean distance"""
-    # Calculate pairwise distances
-    dist_matrix = distance.cdist(positions, positions, 'euclidean')
+if njit is not None:
+    # All fastmath flags except 'nnan' and 'ninf', since the kernel compares
+    # against an infinite sentinel
+    @njit(parallel=True, fastmath={'nsz', 'arcp', 'contract', 'afn', 'reassoc'})
+    def _brute_force_knn(positions, k):
+        """Find the k nearest neighbors of every point by scanning all other points"""
+        n, dims = positions.shape
+        indices = np.empty((n, k), np.int64)
+        distances = np.empty((n, k), np.float64)
+        for i in prange(n):
+            # Keep the k closest points seen so far, sorted by squared distance
+            best_d = np.full(k, np.inf)
+            best_j = np.full(k, -1, np.int64)
+            for j in range(n):
+                if j == i:
+                    continue
+                d = 0.0
+                for c in range(dims):
+                    diff = positions[i, c] - positions[j, c]
+                    d += diff * diff
+                if d < best_d[k-1]:
+                    pos = k - 1
+                    while pos > 0 and best_d[pos-1] > d:
+                        best_d[pos] = best_d[pos-1]
+                        best_j[pos] = best_j[pos-1]
+                        pos -= 1
+                    best_d[pos] = d
+                    best_j[pos] = j
+            indices[i] = best_j
+            distances[i] = np.sqrt(best_d)
+        return indices, distances
+
+def find_nearest_neighbors(positions, n_neighbors, approximate=False, n_trees=50):
+    """Find n nearest neighbors for each point based on Euclidean distance
+
+    Returns:
+        tuple: (indices, distances) arrays of shape (n_points, n_neighbors),
+               ordered from closest to furthest neighbor
+    """
+    if n_neighbors < 1:
+        return np.empty((len(positions), 0), dtype=np.int64), np.empty((len(positions), 0))
+    
+    # KD-trees are exact and fast for low-dimensional layouts, but degrade
+    # towards brute force as the dimension grows, so only use Annoy there
+    low_dimensional = positions.shape[1] <= 8
+    if approximate and not low_dimensional:
+        if AnnoyIndex is None:
+            print("Annoy is not installed; falling back to exact nearest neighbor search")
+        else:
+            return find_approximate_nearest_neighbors(positions, n_neighbors, n_trees)
+    
+    # In high dimensions a BLAS-backed distance matrix beats tree searches
+    if pairwise_distances is not None and not low_dimensional:
+        return find_pairwise_nearest_neighbors(positions, n_neighbors)
     
-    # For each point, get indices of n+1 closest points (including itself)
-    # Then remove itself (which is at index 0)
-    neighbors = []
+    if cKDTree is not None:
+        # Query the n+1 closest points for every position in a single batched call
+        tree = cKDTree(positions)
+        distances, indices = tree.query(positions, k=n_neighbors+1, workers=-1)
+        
+        # Remove each point from its own neighbors. It is not guaranteed to come
+        # first when several points share the same position, and may even be
+        # crowded out of the results, in which case drop the furthest match instead
+        is_self = indices == np.arange(len(positions))[:, None]
+        is_self[~is_self.any(axis=1), -1] = True
+        keep = ~is_self
+        shape = (len(positions), n_neighbors)
+        return indices[keep].reshape(shape), distances[keep].reshape(shape)
+    
+    # Without SciPy, fall back to a compiled brute force search
+    if njit is not None:
+        return _brute_force_knn(np.ascontiguousarray(positions), n_neighbors)
+    
+    if pairwise_distances is not None:
+        return find_pairwise_nearest_neighbors(positions, n_neighbors)
+    
+    raise ImportError("One of scipy, numba or scikit-learn must be installed to find nearest neighbors")
+
+def find_pairwise_nearest_neighbors(positions, n_neighbors, block_size=1024):
+    """Find n nearest neighbors for each point from pairwise distances, computed in row blocks"""
+    n_points = len(positions)
+    indices = np.empty((n_points, n_neighbors), dtype=np.int64)
+    distances = np.empty((n_points, n_neighbors))
+    
+    # Only hold block_size rows of the distance matrix at a time, rather than all N x N
+    for start in range(0, n_points, block_size):
+        end = min(start + block_size, n_points)
+        # pairwise_distances expands ||x-y||^2 as ||x||^2 + ||y||^2 - 2xy to use a
+        # matrix multiply, which can lose a little precision for nearly equal points
+        dist_block = pairwise_distances(positions[start:end], positions, metric='euclidean', n_jobs=-1)
+        
+        # Exclude each point from its own neighbors
+        rows = np.arange(end - start)
+        dist_block[rows, start + rows] = np.inf
+        
+        indices[start:end], distances[start:end] = smallest_k(dist_block, n_neighbors)
+    
+    return indices, distances
+
+def smallest_k(dist_matrix, k):
+    """Return the (indices, distances) of the k smallest values in each row, in ascending order"""
+    # Partition each row so its k smallest values come first, then sort only those
+    indices = np.argpartition(dist_matrix, k-1, axis=1)[:, :k]
+    distances = np.take_along_axis(dist_matrix, indices, axis=1)
+    order = np.argsort(distances, axis=1)
+    return np.take_along_axis(indices, order, axis=1), np.take_along_axis(distances, order, axis=1)
+
+def find_approximate_nearest_neighbors(positions, n_neighbors, n_trees=50):
+    """Find approximate n nearest neighbors for each point using an Annoy index"""
+    index = AnnoyIndex(positions.shape[1], 'euclidean')
+    for i, vector in enumerate(positions):
+        index.add_item(i, vector)
+    index.build(n_trees)
+    
+    def query(i, search_k):
+        closest_indices, closest_distances = index.get_nns_by_item(
+            i, n_neighbors+1, search_k=search_k, include_distances=True)
+        # Remove the point itself, which is not guaranteed to come first when
+        # several points share the same position
+        return [(j, d) for j, d in zip(closest_indices, closest_distances) if j != i][:n_neighbors]
+    
+    indices = np.empty((len(positions), n_neighbors), dtype=np.int64)
+    distances = np.empty((len(positions), n_neighbors))
+    n_exact = 0
     for i in range(len(positions)):
-        # Get indices of closest points
-        closest_indices = np.argsort(dist_matrix[i])
-        # Skip the first one (itself) and take the next n
-        neighbors.append(closest_indices[1:n_neighbors+1])
+        # Start from Annoy's default search_k, and inspect more nodes if too few
+        # neighbors come back
+        search_k = n_trees * (n_neighbors + 1)
+        neighbors = query(i, search_k)
+        while len(neighbors) < n_neighbors and search_k < n_trees * len(positions):
+            search_k *= 4
+            neighbors = query(i, search_k)
         
-    return neighbors
-
-def get_thumbnail_path(data_dir, filename):
-    """Generate path to thumbnail for an image"""
-    # Try different possible thumbnail locations
-    thumb_paths = [
-        os.path.join(data_dir, 'thumbs', os.path.basename(filename)),
-        os.path.join(data_dir, 'data', 'thumbs', os.path.basename(filename))
-    ]
+        if len(neighbors) < n_neighbors:
+            # Fall back to an exact search for this point rather than emit padding
+            n_exact += 1
+            row = np.linalg.norm(positions - positions[i], axis=1)[None, :]
+            row[0, i] = np.inf
+            row_indices, row_distances = smallest_k(row, n_neighbors)
+            indices[i], distances[i] = row_indices[0], row_distances[0]
+        else:
+            indices[i] = [j for j, _ in neighbors]
+            distances[i] = [d for _, d in neighbors]
     
-    for path in thumb_paths:
-        if os.path.exists(path):
-            return path
+    if n_exact:
+        print(f"Warning: Annoy returned too few neighbors for {n_exact} images; used exact search for those")
     
-    # Return a default path even if it doesn't exist
-    return os.path.join(data_dir, 'thumbs', os.path.basename(filename))
-
-def get_original_path(data_dir, filename):
-    """Generate path to original image"""
-    # Try different possible original image locations
-    original_paths = [
-        os.path.join(data_dir, 'originals', os.path.basename(filename)),
-        os.path.join(data_dir, 'data', 'originals', os.path.basename(filename))
+    return indices, distances
+
+def get_image_dir(data_dir, dir_name):
+    """Find the directory holding one kind of image file (e.g. thumbs or originals)"""
+    # Try different possible image locations
+    candidates = [
+        os.path.join(data_dir, dir_name),
+        os.path.join(data_dir, 'data', dir_name)
     ]
     
-    for path in original_paths:
-        if os.path.exists(path):
+    for path in candidates:
+        if os.path.isdir(path):
             return path
     
     # Return a default path even if it doesn't exist
-    return os.path.join(data_dir, 'originals', os.path.basename(filename))
+    return candidates[0]
 
-def extract_network_data(data_dir, n_neighbors, layout_name, include_thumbs=True, include_metadata=True):
-    """Extract network data from PixPlot output
+def get_cache_key(*paths):
+    """Return a cache key recording each file's path and modification time"""
+    return [[os.path.abspath(path), os.stat(path).st_mtime_ns] for path in paths]
+
+def get_cache_path(manifest_path, layout_path):
+    """Return the path prefix for data cached from a layout, stored next to the manifest"""
+    return os.path.join(os.path.dirname(manifest_path), CACHE_PREFIX + os.path.basename(layout_path))
+
+def read_positions_cache(cache_path, cache_key):
+    """Read cached positions and basenames, returning None if they are missing or stale"""
+    if not os.path.exists(cache_path + '.npz'):
+        return None
+    try:
+        with np.load(cache_path + '.npz') as cache:
+            if str(cache['key']) != json.dumps(cache_key):
+                return None
+            return cache['positions'], cache['basenames']
+    except Exception as e:
+        print(f"Error reading cache {cache_path}.npz: {e}")
+        return None
+
+def write_positions_cache(cache_path, cache_key, positions, basenames):
+    """Cache positions and basenames along with the key they were loaded for"""
+    try:
+        np.savez(cache_path + '.npz', key=json.dumps(cache_key), positions=positions, basenames=basenames)
+    except OSError as e:
+        print(f"Could not write cache {cache_path}.npz: {e}")
+
+def read_metadata_cache(cache_path, cache_key):
+    """Read cached metadata, returning None if it is missing or stale"""
+    if not os.path.exists(cache_path + '-metadata.json'):
+        return None
+    cache = read_json(cache_path + '-metadata.json')
+    if not isinstance(cache, dict) or cache.get('key') != cache_key:
+        return None
+    return cache.get('metadata')
+
+def write_metadata_cache(cache_path, cache_key, metadata):
+    """Cache the metadata loaded for each image along with the key it was loaded for"""
+    try:
+        with open(cache_path + '-metadata.json', 'w', encoding='utf-8') as f:
+            json.dump({'key': cache_key, 'metadata': metadata}, f)
+    except (OSError, TypeError) as e:
+        print(f"Could not write cache {cache_path}-metadata.json: {e}")
+
+def find_data_paths(data_dir, manifest_path, layout_name):
+    """Find the imagelist and layout files described by a manifest
     
     Returns:
-        tuple: (network_data, metadata_dict) where network_data is a list of edge dictionaries
-               and metadata_dict is a dictionary of metadata for each image
+        tuple: (imagelist_path, layout_path, is_gzipped)
     """
-    # First identify the plot_id from the manifest
-    # This will help us locate the correct files
-    print(timestamp(), f"Looking for PixPlot data in: {data_dir}")
-    
-    # Find all possible manifest.json files
-    manifest_candidates = [
-        os.path.join(data_dir, 'manifest.json'),
-        os.path.join(data_dir, 'data', 'manifest.json')
-    ]
-    
-    manifest_path = None
-    for path in manifest_candidates:
-        if os.path.exists(path):
-            manifest_path = path
-            break
-            
-    if not manifest_path:
-        print(f"Manifest file not found in any expected location")
-        return None
-    
-    print(f"Found manifest at {manifest_path}")
     manifest = read_json(manifest_path)
     if not manifest:
         print("Failed to read manifest")
@@ -194,15 +416,15 @@ def extract_network_data(data_dir, n_neighbors, layout_name, include_thumbs=True
     is_gzipped = manifest.get('gzipped', False)
     print(f"Plot ID: {plot_id}, Gzipped: {is_gzipped}")
     
-    # Find and load the imagelist
+    # Find the imagelist
     imagelist_path = manifest.get('imagelist')
     if not imagelist_path:
         print("Image list path not found in manifest")
         
         # Try to find an imagelist in the expected directory
-        imagelist_candidates = glob.glob(os.path.join(data_dir, 'imagelists', 'imagelist*.json*'))
+        imagelist_candidates = find_files(os.path.join(data_dir, 'imagelists'), 'imagelist*.json*')
         if not imagelist_candidates:
-            imagelist_candidates = glob.glob(os.path.join(data_dir, 'data', 'imagelists', 'imagelist*.json*'))
+            imagelist_candidates = find_files(os.path.join(data_dir, 'data', 'imagelists'), 'imagelist*.json*')
             
         if imagelist_candidates:
             imagelist_path = imagelist_candidates[0]
@@ -223,19 +445,6 @@ def extract_network_data(data_dir, n_neighbors, layout_name, include_thumbs=True
                     print(f"Could not find imagelist file: {relative_path}")
                     return None
 
-    print(f"Loading imagelist from {imagelist_path}")
-    image_list_data = read_json(imagelist_path, gzipped=is_gzipped)
-    if not image_list_data:
-        print("Failed to read imagelist")
-        return None
-        
-    image_filenames = image_list_data.get('images', [])
-    if not image_filenames:
-        print("No images found in image list")
-        return None
-    
-    print(f"Found {len(image_filenames)} images in the image list")
-    
     # Get the layout for finding neighbors
     if layout_name == 'umap' and 'umap' in manifest.get('layouts', {}):
         # For UMAP, we need to handle the variants
@@ -254,9 +463,9 @@ def extract_network_data(data_dir, n_neighbors, layout_name, include_thumbs=True
         print(f"Layout file for {layout_name} not found")
         
         # Try to look for any umap layout files
-        layout_files = glob.glob(os.path.join(data_dir, 'layouts', 'umap*.json*'))
+        layout_files = find_files(os.path.join(data_dir, 'layouts'), 'umap*.json*')
         if not layout_files:
-            layout_files = glob.glob(os.path.join(data_dir, 'data', 'layouts', 'umap*.json*'))
+            layout_files = find_files(os.path.join(data_dir, 'data', 'layouts'), 'umap*.json*')
         
         if layout_files:
             layout_path = layout_files[0]
@@ -265,9 +474,35 @@ def extract_network_data(data_dir, n_neighbors, layout_name, include_thumbs=True
             print("Could not find any layout files")
             return None
     
-    # Load the positions from the layout
+    return imagelist_path, layout_path, is_gzipped
+
+def load_positions(imagelist_path, layout_path, is_gzipped=False):
+    """Load the layout positions and image basenames
+    
+    Returns:
+        tuple: (positions, basenames) where positions is a float32 array with one row per
+               image and basenames is an array of the matching image filenames
+    """
+    # The imagelist and layout are independent, so read them concurrently
+    print(f"Loading imagelist from {imagelist_path}")
     print(f"Loading positions from {layout_path}")
-    positions_data = read_json(layout_path, gzipped=is_gzipped)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        image_list_future = executor.submit(read_json, imagelist_path, gzipped=is_gzipped)
+        positions_future = executor.submit(read_json, layout_path, gzipped=is_gzipped)
+        image_list_data = image_list_future.result()
+        positions_data = positions_future.result()
+    
+    if not image_list_data:
+        print("Failed to read imagelist")
+        return None
+        
+    image_filenames = image_list_data.get('images', [])
+    if not image_filenames:
+        print("No images found in image list")
+        return None
+    
+    print(f"Found {len(image_filenames)} images in the image list")
+    
     if not positions_data:
         print("Failed to read positions data")
         return None
@@ -278,7 +513,9 @@ def extract_network_data(data_dir, n_neighbors, layout_name, include_thumbs=True
     else:
         positions = positions_data
     
-    positions = np.array(positions)
+    # Single precision is plenty to rank neighbors, and halves the memory
+    # and bandwidth of every distance computation
+    positions = np.ascontiguousarray(positions, dtype=np.float32)
     
     if len(positions) != len(image_filenames):
         print(f"Warning: Number of positions ({len(positions)}) doesn't match number of images ({len(image_filenames)})")
@@ -287,142 +524,170 @@ def extract_network_data(data_dir, n_neighbors, layout_name, include_thumbs=True
         positions = positions[:min_count]
         image_filenames = image_filenames[:min_count]
     
-    # Find nearest neighbors
-    print(f"Finding {n_neighbors} nearest neighbors for each image")
-    neighbors = find_nearest_neighbors(positions, n_neighbors)
+    # Strip directories from the image filenames once, for metadata lookups and node ids
+    basenames = np.array([os.path.basename(filename) for filename in image_filenames])
     
-    # Load metadata if requested
-    metadata = {}
-    if include_metadata:
-        print("Loading metadata")
-        metadata = load_metadata(data_dir, image_filenames)
+    return positions, basenames
+
+def extract_network_data(data_dir, n_neighbors, layout_name, include_thumbs=True, include_metadata=True,
+                         approximate=False, n_trees=50, use_cache=False):
+    """Extract network data from PixPlot output
     
-    # Prepare network data
-    network_data = []
-    print("Creating network data")
+    Returns:
+        tuple: (network_data, node_data, metadata_dict) where network_data and node_data are
+               dictionaries mapping each edge or node column to a NumPy array with one entry
+               per edge or node, and metadata_dict is a dictionary of metadata for each image
+    """
+    # First identify the plot_id from the manifest
+    # This will help us locate the correct files
+    print(timestamp(), f"Looking for PixPlot data in: {data_dir}")
     
-    for i, filename in enumerate(image_filenames):
-        base_filename = os.path.basename(filename)
-        
-        # Get the nearest neighbors for this image
-        neighbor_indices = neighbors[i]
+    # Find all possible manifest.json files
+    manifest_candidates = [
+        os.path.join(data_dir, 'manifest.json'),
+        os.path.join(data_dir, 'data', 'manifest.json')
+    ]
+    
+    manifest_path = None
+    for path in manifest_candidates:
+        if os.path.exists(path):
+            manifest_path = path
+            break
+            
+    if not manifest_path:
+        print(f"Manifest file not found in any expected location")
+        return None
+    
+    print(f"Found manifest at {manifest_path}")
+    
+    paths = find_data_paths(data_dir, manifest_path, layout_name)
+    if not paths:
+        return None
+    imagelist_path, layout_path, is_gzipped = paths
+    
+    # Reuse the parsed positions from a previous run if none of their source files changed
+    cache_path = get_cache_path(manifest_path, layout_path) if use_cache else None
+    cached = None
+    positions_key = None
+    if cache_path:
+        positions_key = get_cache_key(manifest_path, imagelist_path, layout_path)
+        cached = read_positions_cache(cache_path, positions_key)
+    if cached:
+        print(f"Loading cached positions from {cache_path}.npz")
+        positions, basenames = cached
+    else:
+        result = load_positions(imagelist_path, layout_path, is_gzipped)
+        if not result:
+            return None
+        positions, basenames = result
+        if cache_path:
+            write_positions_cache(cache_path, positions_key, positions, basenames)
+    
+    # Each image can have at most every other image as a neighbor
+    if n_neighbors >= len(positions):
+        n_neighbors = len(positions) - 1
+        print(f"Warning: Only {len(positions)} images available, reducing n_neighbors to {n_neighbors}")
+    
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # Load metadata if requested, reading files while the neighbor search runs
+        metadata_future = None
+        if include_metadata:
+            print("Loading metadata")
+            metadata_future = executor.submit(load_metadata, data_dir, basenames.tolist(), cache_path, positions_key)
         
-        # Get the position data for visualization
-        pos_x, pos_y = positions[i]
+        # Find nearest neighbors
+        print(f"Finding {n_neighbors} nearest neighbors for each image")
+        neighbors, neighbor_distances = find_nearest_neighbors(positions, n_neighbors, approximate=approximate, n_trees=n_trees)
         
-        # Create a row for each neighbor relationship
-        for j, neighbor_idx in enumerate(neighbor_indices):
-            neighbor_filename = os.path.basename(image_filenames[neighbor_idx])
-            
-            # Calculate distance between points
-            distance_val = distance.euclidean(positions[i], positions[neighbor_idx])
-            
-            row = {
-                'source': base_filename,
-                'target': neighbor_filename,
-                'weight': 1.0 / (distance_val + 1e-5),  # Convert distance to weight (closer = higher weight)
-                'distance': distance_val,
-                'rank': j + 1,  # Neighbor rank (1 = closest)
-                'source_x': pos_x,
-                'source_y': pos_y,
-                'target_x': positions[neighbor_idx][0],
-                'target_y': positions[neighbor_idx][1],
-            }
-            
-            # No longer adding thumbnail paths to edges - they will be added to nodes instead
-            
-            # No longer adding metadata to edges - it will be added to nodes instead
-            
-            network_data.append(row)
+        metadata = metadata_future.result() if metadata_future else {}
     
-    print(f"Created network data with {len(network_data)} connections")
-    # Return both the network data and the metadata
-    return network_data, metadata
+    # Prepare network data as one array per column, with n_neighbors
+    # consecutive rows (one per neighbor relationship) for each source image
+    print("Creating network data")
+    n_images, k = neighbors.shape
+    targets = neighbors.ravel()
+    distances = neighbor_distances.ravel()
+    
+    network_data = {
+        'source': np.repeat(basenames, k),
+        'target': basenames[targets],
+        'weight': 1.0 / (distances + 1e-5),  # Convert distance to weight (closer = higher weight)
+        'distance': distances,
+        'rank': np.tile(np.arange(1, k+1), n_images),  # Neighbor rank (1 = closest)
+        'source_x': np.repeat(positions[:, 0], k),
+        'source_y': np.repeat(positions[:, 1], k),
+        'target_x': positions[targets, 0],
+        'target_y': positions[targets, 1],
+    }
+    
+    # Every image is the source of its own edges, and every target is one of
+    # the images, so the nodes are exactly the images in order
+    node_data = {
+        'id': basenames,
+        'x': positions[:, 0],
+        'y': positions[:, 1],
+    }
+    
+    print(f"Created network data with {len(targets)} connections")
+    # Return the network data, node data and metadata
+    return network_data, node_data, metadata
 
 def write_csv(network_data, output_path):
-    """Write network data to CSV file"""
-    if not network_data:
+    """Write network data (a dictionary of column arrays) to CSV file"""
+    if not network_data or not len(network_data['source']):
         print("No network data to write")
         return False
     
-    # Get all unique column names
-    fieldnames = set()
-    for row in network_data:
-        fieldnames.update(row.keys())
-    
     # Make sure essential columns come first
     essential_cols = ['source', 'target', 'weight', 'distance', 'rank']
-    fieldnames = essential_cols + sorted(list(fieldnames - set(essential_cols)))
+    fieldnames = essential_cols + sorted(list(set(network_data.keys()) - set(essential_cols)))
     
     try:
-        with open(output_path, 'w', newline='', encoding='utf-8') as f:
-            writer = csv.DictWriter(f, fieldnames=fieldnames)
-            writer.writeheader()
-            writer.writerows(network_data)
-        print(f"Wrote {len(network_data)} relationships to {output_path}")
+        df = pd.DataFrame(network_data, columns=fieldnames)
+        with open(output_path, 'w', newline='', encoding='utf-8', buffering=CSV_BUFFER_SIZE) as f:
+            df.to_csv(f, index=False, float_format='%.6g', chunksize=100000)
+        print(f"Wrote {len(network_data['source'])} relationships to {output_path}")
         return True
     except Exception as e:
         print(f"Error writing CSV: {e}")
         return False
 
-def create_node_csv(network_data, metadata, data_dir, include_thumbs, output_path):
-    """Create a nodes CSV file with unique nodes and their attributes"""
-    if not network_data:
-        print("No network data to create node file")
+def create_node_csv(node_data, metadata, data_dir, include_thumbs, output_path):
+    """Create a nodes CSV file from node data (a dictionary of column arrays) and metadata"""
+    if not node_data or not len(node_data['id']):
+        print("No node data to create node file")
         return False
     
-    nodes = {}
-    
-    # Collect unique nodes and their positions
-    for row in network_data:
-        # Process source node
-        source = row['source']
-        if source not in nodes:
-            nodes[source] = {
-                'id': source,
-                'x': row['source_x'],
-                'y': row['source_y']
-            }
-            
-            # Add thumbnail paths if requested
-            if include_thumbs:
-                nodes[source]['thumb'] = get_thumbnail_path(data_dir, source)
-                nodes[source]['original'] = get_original_path(data_dir, source)
-        
-        # Process target node
-        target = row['target']
-        if target not in nodes:
-            nodes[target] = {
-                'id': target,
-                'x': row['target_x'],
-                'y': row['target_y']
-            }
-            
-            # Add thumbnail paths if requested
-            if include_thumbs:
-                nodes[target]['thumb'] = get_thumbnail_path(data_dir, target)
-                nodes[target]['original'] = get_original_path(data_dir, target)
-    
-    # Add metadata to nodes
-    for node_id in nodes:
-        if node_id in metadata:
-            for key, value in metadata[node_id].items():
-                if key != 'filename':  # Skip filename to avoid duplication
-                    nodes[node_id][key] = value
-    
-    # Get all possible field names
-    fieldnames = set()
-    for node_data in nodes.values():
-        fieldnames.update(node_data.keys())
+    nodes = pd.DataFrame(node_data)
+    
+    # Format the computed positions the same way as in the edges file, so the
+    # 6 digit format never touches metadata columns
+    for col in ['x', 'y']:
+        nodes[col] = [f"{value:.6g}" for value in nodes[col].tolist()]
+    
+    # Add thumbnail paths if requested, resolving the image directories once
+    if include_thumbs:
+        thumbs_dir = get_image_dir(data_dir, 'thumbs')
+        originals_dir = get_image_dir(data_dir, 'originals')
+        nodes['thumb'] = [os.path.join(thumbs_dir, node_id) for node_id in nodes['id']]
+        nodes['original'] = [os.path.join(originals_dir, node_id) for node_id in nodes['id']]
+    
+    # Add metadata to nodes, letting metadata values take precedence
+    if metadata:
+        # Use object columns so values are written as read, e.g. integer columns
+        # with missing entries are not converted to floats
+        node_metadata = pd.DataFrame([metadata.get(node_id, {}) for node_id in nodes['id']],
+                                     index=nodes.index, dtype=object)
+        # Skip filename to avoid duplication
+        node_metadata = node_metadata.drop(columns=['filename'], errors='ignore')
+        nodes = node_metadata.combine_first(nodes)
     
     # Ensure 'id' is the first column
-    fieldnames = ['id'] + sorted(list(fieldnames - {'id'}))
+    fieldnames = ['id'] + sorted(list(set(nodes.columns) - {'id'}))
     
     try:
-        with open(output_path, 'w', newline='', encoding='utf-8') as f:
-            writer = csv.DictWriter(f, fieldnames=fieldnames)
-            writer.writeheader()
-            writer.writerows(nodes.values())
+        with open(output_path, 'w', newline='', encoding='utf-8', buffering=CSV_BUFFER_SIZE) as f:
+            nodes.to_csv(f, columns=fieldnames, index=False)
         print(f"Wrote {len(nodes)} nodes to {output_path}")
         return True
     except Exception as e:
@@ -437,6 +702,9 @@ def main():
     parser.add_argument('--layout', type=str, default='umap', help='Layout to use for finding neighbors')
     parser.add_argument('--include_thumbs', action='store_true', help='Include thumbnail paths in output')
     parser.add_argument('--include_metadata', action='store_true', help='Include metadata in output')
+    parser.add_argument('--approximate', action='store_true', help='Use an approximate (Annoy) nearest neighbor index for high-dimensional layouts')
+    parser.add_argument('--n_trees', type=int, default=50, help='Number of trees to build in the approximate index')
+    parser.add_argument('--no_cache', action='store_true', help='Reload all PixPlot data instead of using data cached by a previous run')
     
     args = parser.parse_args()
     
@@ -454,16 +722,19 @@ def main():
         args.n_neighbors, 
         args.layout,
         include_thumbs=args.include_thumbs,
-        include_metadata=args.include_metadata
+        include_metadata=args.include_metadata,
+        approximate=args.approximate,
+        n_trees=args.n_trees,
+        use_cache=not args.no_cache
     )
     
     if not result:
         print("Failed to extract network data")
         return
         
-    network_data, metadata = result
+    network_data, node_data, metadata = result
     
-    if not network_data:
+    if not len(network_data['source']):
         print("No network data was generated")
         return
     
@@ -475,7 +746,7 @@ def main():
         # Create and write nodes CSV
         nodes_path = os.path.splitext(args.output)[0] + "_nodes.csv"
         create_node_csv(
-            network_data, 
+            node_data, 
             metadata,  # Pass the metadata directly to the node creation function
             args.data_dir,
             args.include_thumbs,